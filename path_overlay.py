@@ -1,92 +1,37 @@
 #!/usr/bin/env python3
+import gzip
+import hashlib
+import io
 import os
+import threading
+import numpy as np
 import requests
-import xml.etree.ElementTree as ET
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import json
 
-def parse_gpx_coordinates(gpx_content):
-    """Extract coordinates from GPX content"""
+# Prefer lxml (libxml2) for GPX parsing; the stdlib parser is the fallback.
+# xml.etree.cElementTree is gone since Python 3.9 and ElementTree already
+# uses the C accelerator, so there is no separate cElementTree step.
+# Without lxml, defusedxml (if installed) guards the stdlib parser against
+# entity-expansion bombs from an untrusted server.
+try:
+    from lxml import etree as ET
+    HAVE_LXML = True
+except ImportError:
     try:
-        root = ET.fromstring(gpx_content)
-        
-        # Handle GPX namespace
-        ns = {'gpx': 'http://www.topografix.com/GPX/1/1'}
-        
-        coordinates = []
-        
-        # Look for track points in tracks
-        for trkpt in root.findall('.//gpx:trkpt', ns):
-            lat = float(trkpt.get('lat'))
-            lon = float(trkpt.get('lon'))
-            coordinates.append([lat, lon])
-        
-        # Also check for waypoints
-        for wpt in root.findall('.//gpx:wpt', ns):
-            lat = float(wpt.get('lat'))
-            lon = float(wpt.get('lon'))
-            coordinates.append([lat, lon])
-        
-        return coordinates
-    except Exception as e:
-        print(f"Error parsing GPX: {e}")
-        return []
+        import defusedxml.ElementTree as ET
+    except ImportError:
+        import xml.etree.ElementTree as ET
+    HAVE_LXML = False
 
-def generate_html_map(paths_by_year, output_file, month_day):
-    """Generate interactive HTML map"""
-    
-    # Calculate map center from all coordinates
-    all_coords = []
-    for year, coords in paths_by_year.items():
-        all_coords.extend(coords)
-    
-    if not all_coords:
-        print("❌ No coordinates found!")
-        return
-    
-    center_lat = sum(coord[0] for coord in all_coords) / len(all_coords)
-    center_lon = sum(coord[1] for coord in all_coords) / len(all_coords)
-    
-    # Color palette for different years - bright, high contrast colors
-    colors = [
-        '#FF0000', '#00FF00', '#0000FF', '#FFFF00', '#FF00FF',
-        '#00FFFF', '#FF8800', '#8800FF', '#FF0088', '#00FF88',
-        '#88FF00', '#0088FF', '#FF6600', '#6600FF', '#FF0066'
-    ]
-    
-    # Create JavaScript arrays for paths
-    polylines_js = []
-    legend_items = []
-    
-    for i, (year, coords) in enumerate(paths_by_year.items()):
-        if not coords:
-            continue
-            
-        color = colors[i % len(colors)]
-        
-        # Create polyline coordinates string
-        coords_str = ', '.join(f'[{lat}, {lon}]' for lat, lon in coords)
-        
-        polylines_js.append(f"""
-        // Path for {year}
-        var path{year} = L.polyline([{coords_str}], {{
-            color: '{color}',
-            weight: 5,
-            opacity: 0.9
-        }}).addTo(map).bindPopup('{year}: {len(coords)} points');
-        
-        // Add zoom-dependent styling
-        map.on('zoomend', function() {{
-            var zoom = map.getZoom();
-            var weight = zoom < 10 ? 8 : (zoom < 13 ? 5 : 3);
-            path{year}.setStyle({{ weight: weight }});
-        }});
-        """)
-        
-        legend_items.append(f'<div><span style="color: {color}; font-weight: bold; font-size: 20px;">■</span> {year} ({len(coords)} points)</div>')
-    
-    # Generate HTML
-    html_content = f"""
+# Qualified GPX 1.1 tag names emitted by Reitti's export
+GPX_TRKPT = '{http://www.topografix.com/GPX/1/1}trkpt'
+GPX_WPT = '{http://www.topografix.com/GPX/1/1}wpt'
+
+# Static parts of the generated page, filled in with str.format_map
+HTML_HEAD = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -131,15 +76,6 @@ def generate_html_map(paths_by_year, output_file, month_day):
 </head>
 <body>
     <div id="map"></div>
-    <div class="legend">
-        <h3>Paths for {month_day}</h3>
-        {''.join(legend_items)}
-    </div>
-    <div class="info">
-        <strong>Date:</strong> {month_day}<br>
-        <strong>Years with Data:</strong> {len(paths_by_year)}<br>
-        <strong>Total Points:</strong> {len(all_coords)}
-    </div>
 
     <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
     <script>
@@ -153,30 +89,295 @@ def generate_html_map(paths_by_year, output_file, month_day):
             maxZoom: 20
         }}).addTo(map);
         
-        {''.join(polylines_js)}
+        // Every year's polyline, restyled together on zoom
+        var allPaths = [];
+        
+        """
+
+# Legend and info boxes are absolutely positioned, so they can follow the
+# script and be written after the polylines in the same pass
+HTML_SCRIPT_END = """
+        
+        // Add zoom-dependent styling with one handler for all paths
+        map.on('zoomend', function() {{
+            var zoom = map.getZoom();
+            var weight = zoom < 10 ? 8 : (zoom < 13 ? 5 : 3);
+            allPaths.forEach(function(path) {{
+                path.setStyle({{ weight: weight }});
+            }});
+        }});
         
         // Fit map to all paths
-        var allCoords = [{', '.join(f'[{lat}, {lon}]' for lat, lon in all_coords)}];
-        if (allCoords.length > 0) {{
-            var group = new L.featureGroup();
-            {''.join(f'group.addLayer(path{year});' for year in paths_by_year.keys() if paths_by_year[year])}
-            map.fitBounds(group.getBounds().pad(0.1));
+        if (allPaths.length > 0) {{
+            map.fitBounds(L.featureGroup(allPaths).getBounds().pad(0.1));
         }}
     </script>
+    <div class="legend">
+        <h3>Paths for {month_day}</h3>
+        """
+
+HTML_TAIL = """
+    </div>
+    <div class="info">
+        <strong>Date:</strong> {month_day}<br>
+        <strong>Years with Data:</strong> {year_count}<br>
+        <strong>Total Points:</strong> {total_points}
+    </div>
 </body>
 </html>
     """
+
+POLYLINE_TEMPLATE = """
+        // Path for {year}
+        var {path_var} = L.polyline({coords_str}, {{
+            color: '{color}',
+            weight: 5,
+            opacity: 0.9
+        }}).addTo(map).bindPopup('{year}: {count} points');
+        allPaths.push({path_var});
+        """
+
+LEGEND_ITEM_TEMPLATE = '<div><span style="color: {color}; font-weight: bold; font-size: 20px;">■</span> {year} ({count} points)</div>'
+
+def parse_gpx_coordinates(gpx_content):
+    """Extract coordinates from GPX content (bytes), streaming with iterparse"""
+    try:
+        coordinates = []
+        waypoints = []
+        
+        # Single pass over the document, clearing each point once it is read.
+        # With lxml the tag filter runs inside libxml2 and entities stay unexpanded.
+        kwargs = {'tag': (GPX_TRKPT, GPX_WPT), 'resolve_entities': False} if HAVE_LXML else {}
+        context = ET.iterparse(io.BytesIO(gpx_content), events=("end",), **kwargs)
+        for _, elem in context:
+            if elem.tag == GPX_TRKPT:
+                coordinates.append([float(elem.get('lat')), float(elem.get('lon'))])
+            elif elem.tag == GPX_WPT:
+                waypoints.append([float(elem.get('lat')), float(elem.get('lon'))])
+            else:
+                continue
+            elem.clear()
+            # lxml keeps cleared siblings attached to their parent; drop them too
+            if HAVE_LXML:
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        context.root.clear()
+        
+        # Waypoints go after the track points, as before
+        coordinates.extend(waypoints)
+        return coordinates
+    except Exception as e:
+        print(f"Error parsing GPX: {e}")
+        return []
+
+def create_session(api_token, pool_size):
+    """Create a Reitti API session whose connection pool fits every fetch worker"""
+    session = requests.Session()
+    session.headers.update({'X-API-TOKEN': api_token})
+    
+    # One host, but keep a kept-alive connection per worker thread
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def load_cached_gpx(cache_path):
+    """Read a cached GPX body and its validators (ETag / Last-Modified)"""
+    with open(cache_path, 'rb') as f:
+        content = f.read()
+    try:
+        with open(cache_path + '.meta') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = {}
+    return content, meta
+
+def write_atomic(path, data):
+    """Write bytes to path via a temp file, so a killed run never leaves a partial file"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def save_cached_gpx(cache_path, meta, content=None):
+    """Store a GPX body (if given) plus its validators and fetch time next to it"""
+    meta = dict(meta, fetched_at=datetime.now().isoformat(timespec='seconds'))
+    write_atomic(cache_path + '.meta', json.dumps(meta).encode())
+    # The body goes last: its presence is what marks the cache entry as usable
+    if content is not None:
+        write_atomic(cache_path, content)
+
+def is_final(meta, date_str):
+    """True if the cached export was fetched after its day had ended, so it can't change"""
+    try:
+        fetched_at = datetime.fromisoformat(meta['fetched_at'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return fetched_at >= datetime.strptime(date_str, '%Y-%m-%d') + timedelta(days=1)
+
+def fetch_year(session, gpx_url, date_str, cache_dir=None):
+    """Fetch and parse the GPX export for one date, returns (coordinates, status)"""
+    params = {'start': date_str, 'end': date_str}
+    headers = {}
+    cached = None
+    meta = {}
+    cache_path = os.path.join(cache_dir, f"{date_str}.gpx") if cache_dir else None
+    
+    try:
+        if cache_path and os.path.exists(cache_path):
+            content, meta = load_cached_gpx(cache_path)
+            # A cached body that no longer parses is ignored and fetched again
+            cached = parse_gpx_coordinates(content) or None
+            if cached:
+                # A day that was already over when fetched never changes
+                if is_final(meta, date_str):
+                    return cached, f"✅ {len(cached)} points (cached)"
+                # Otherwise (e.g. today's partial export) revalidate it
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+        
+        response = session.get(gpx_url, params=params, headers=headers, timeout=10)
+        if response.status_code == 304 and cached:
+            # Record the revalidation time, so a finished day becomes final
+            save_cached_gpx(cache_path, meta)
+            return cached, f"✅ {len(cached)} points (not modified)"
+        if response.status_code == 200 and len(response.content) > 1000:
+            coordinates = parse_gpx_coordinates(response.content)
+            if not coordinates:
+                return None, "❌ No coordinates parsed"
+            # Only exports with points are cached, so empty days are retried
+            if cache_path:
+                save_cached_gpx(cache_path, {
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                }, response.content)
+            return coordinates, f"✅ {len(coordinates)} points"
+        return None, f"❌ No data ({len(response.content)} bytes)"
+    except Exception as e:
+        return None, f"❌ Error: {e}"
+
+def simplify_path(coords, tolerance):
+    """Ramer-Douglas-Peucker simplification of a path, tolerance in degrees"""
+    points = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    if tolerance <= 0 or len(points) < 3:
+        return points
+    
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
     
-    with open(output_file, 'w') as f:
-        f.write(html_content)
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        
+        # Distance of every interior point to the start-end chord, in one go
+        chord = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        chord_len = np.hypot(chord[0], chord[1])
+        if chord_len == 0:
+            dists = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            dists = np.abs(chord[0] * offsets[:, 1] - chord[1] * offsets[:, 0]) / chord_len
+        
+        idx = int(dists.argmax())
+        if dists[idx] > tolerance:
+            split = start + 1 + idx
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    
+    return points[keep]
+
+def generate_html_map(paths_by_year, output_file, month_day, compress=False, point_counts=None):
+    """Generate interactive HTML map (gzipped to output_file + '.gz' if compress), returns its path"""
+    
+    # One (n, 2) array per year; the map center is the mean of all of them
+    years = list(paths_by_year)
+    arrs = [np.asarray(paths_by_year[year], dtype=np.float64).reshape(-1, 2) for year in years]
+    all_coords = np.concatenate(arrs) if arrs else np.empty((0, 2))
+    # Labels show recorded GPS points (point_counts: year -> count), not simplified vertices
+    counts = [(point_counts or {}).get(year, len(arr)) for year, arr in zip(years, arrs)]
+    
+    if not len(all_coords):
+        print("❌ No coordinates found!")
+        return None
+    
+    center_lat, center_lon = all_coords.mean(axis=0).tolist()
+    
+    # Color palette for different years - bright, high contrast colors
+    colors = [
+        '#FF0000', '#00FF00', '#0000FF', '#FFFF00', '#FF00FF',
+        '#00FFFF', '#FF8800', '#8800FF', '#FF0088', '#00FF88',
+        '#88FF00', '#0088FF', '#FF6600', '#6600FF', '#FF0066'
+    ]
+    
+    # Stream the page: head, one polyline block per year, then legend and info
+    emitted = []
+    if compress:
+        output_file += '.gz'
+        out = gzip.open(output_file, 'wt', compresslevel=6)
+    else:
+        out = open(output_file, 'w', buffering=1 << 20)
+    
+    with out as f:
+        f.write(HTML_HEAD.format_map({
+            'month_day': month_day,
+            'center_lat': center_lat,
+            'center_lon': center_lon,
+        }))
+        
+        for i, (year, coords, count) in enumerate(zip(years, arrs, counts)):
+            if not len(coords):
+                continue
+            
+            color = colors[i % len(colors)]
+            # Short index-based names keep the generated JS small
+            path_var = f'p{len(emitted)}'
+            
+            # Create polyline coordinates string (a JSON array is a valid JS literal)
+            coords_str = json.dumps(coords.tolist(), separators=(',', ':'))
+            
+            f.write(POLYLINE_TEMPLATE.format_map({
+                'year': year, 'path_var': path_var, 'coords_str': coords_str,
+                'color': color, 'count': count,
+            }))
+            emitted.append((year, color, count))
+        
+        f.write(HTML_SCRIPT_END.format_map({'month_day': month_day}))
+        
+        for year, color, count in emitted:
+            f.write(LEGEND_ITEM_TEMPLATE.format_map({
+                'color': color, 'year': year, 'count': count,
+            }))
+        
+        f.write(HTML_TAIL.format_map({
+            'month_day': month_day,
+            'year_count': len(paths_by_year),
+            'total_points': sum(counts),
+        }))
     
     print(f"✅ Generated: {output_file}")
+    return output_file
 
 def main():
     reitti_url = os.getenv('REITTI_URL', 'http://192.168.79.2:8030')
     api_token = os.getenv('REITTI_API_TOKEN')
     start_year = int(os.getenv('START_YEAR', '2012'))
     end_year = int(os.getenv('END_YEAR', '2025'))
+    fetch_workers = int(os.getenv('FETCH_WORKERS', '8'))
+    # Write path_overlay_*.html.gz for serving with Content-Encoding: gzip
+    gzip_output = os.getenv('GZIP_OUTPUT', '').lower() in ('1', 'true', 'yes')
+    # Roughly 10m; set SIMPLIFY_TOLERANCE=0 to keep every point
+    simplify_tolerance = float(os.getenv('SIMPLIFY_TOLERANCE', '1e-4'))
+    # Set GPX_CACHE_DIR to an empty string to disable the on-disk cache
+    cache_dir = os.getenv('GPX_CACHE_DIR', '/output/gpx_cache')
     
     if not api_token:
         print("ERROR: REITTI_API_TOKEN not set")
@@ -197,30 +398,33 @@ def main():
     print(f"Years: {start_year}-{end_year}")
     print()
     
-    # Fetch paths for this date across years
-    headers = {'X-API-TOKEN': api_token}
+    # Fetch paths for this date across years, overlapping the requests
+    session = create_session(api_token, fetch_workers)
+    gpx_url = f"{reitti_url}/api/v1/gpx/export"
+    dates = [(year, f"{year}-{month_day}") for year in range(start_year, end_year + 1)]
     paths_by_year = {}
+    point_counts = {}
+    
+    if cache_dir:
+        # Separate caches per instance and account, so switching either never serves stale data
+        cache_key = hashlib.sha256(f"{reitti_url}\n{api_token}".encode()).hexdigest()[:12]
+        cache_dir = os.path.join(cache_dir, cache_key)
+        os.makedirs(cache_dir, exist_ok=True)
+    
+    with session, ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+        results = list(executor.map(
+            lambda item: fetch_year(session, gpx_url, item[1], cache_dir), dates))
     
-    for year in range(start_year, end_year + 1):
-        date_str = f"{year}-{month_day}"
+    # Report in year order once all fetches are done
+    for (year, date_str), (coordinates, status) in zip(dates, results):
         print(f"  Fetching {date_str}...")
-        
-        gpx_url = f"{reitti_url}/api/v1/gpx/export"
-        params = {'start': date_str, 'end': date_str}
-        
-        try:
-            response = requests.get(gpx_url, headers=headers, params=params, timeout=10)
-            if response.status_code == 200 and len(response.content) > 1000:
-                coordinates = parse_gpx_coordinates(response.text)
-                if coordinates:
-                    paths_by_year[year] = coordinates
-                    print(f"    ✅ {len(coordinates)} points")
-                else:
-                    print(f"    ❌ No coordinates parsed")
-            else:
-                print(f"    ❌ No data ({len(response.content)} bytes)")
-        except Exception as e:
-            print(f"    ❌ Error: {e}")
+        print(f"    {status}")
+        if coordinates:
+            path = simplify_path(coordinates, simplify_tolerance)
+            if len(path) < len(coordinates):
+                print(f"    ↳ simplified to {len(path)} points")
+            paths_by_year[year] = path
+            point_counts[year] = len(coordinates)
     
     if not paths_by_year:
         print(f"\n❌ No path data found for {month_day} in any year from {start_year}-{end_year}!")
@@ -229,7 +433,8 @@ def main():
     
     # Generate HTML map
     output_file = f"/output/path_overlay_{month_day}_{start_year}-{end_year}.html"
-    generate_html_map(paths_by_year, output_file, month_day)
+    output_file = generate_html_map(paths_by_year, output_file, month_day, compress=gzip_output,
+                                    point_counts=point_counts)
     
     print(f"\n🎉 Success! Generated overlay for {month_day} with {len(paths_by_year)} years of data")
     print(f"📁 Output: {output_file}")
@@ -4,12 +4,17 @@ Reitti "This Day That Year" Screenshot Collage Generator
 Creates a collage of screenshots from the same day/month across multiple years.
 """
 
+import base64
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.common.by import By
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 from PIL import Image
 import time
@@ -22,38 +27,63 @@ START_YEAR = int(os.getenv("START_YEAR", "2012"))
 SCREENSHOT_DIR = "/output/screenshots"
 OUTPUT_DIR = "/output/collages"
 WAIT_TIME = int(os.getenv("WAIT_TIME", "5"))
+# Element that shows the day's track has been drawn; WAIT_TIME is the upper bound
+READY_SELECTOR = os.getenv("READY_SELECTOR", ".leaflet-overlay-pane path")
+# How long to keep looking for the track once tiles are in; days without one stop here
+TRACK_WAIT_TIME = float(os.getenv("TRACK_WAIT_TIME", "1"))
+# Extra pause once the map looks ready, for the last repaint to land
+SETTLE_TIME = float(os.getenv("SETTLE_TIME", "0.5"))
 LOGIN_WAIT_TIME = int(os.getenv("LOGIN_WAIT_TIME", "3"))
 SCREENSHOT_WIDTH = int(os.getenv("SCREENSHOT_WIDTH", "1920"))
 SCREENSHOT_HEIGHT = int(os.getenv("SCREENSHOT_HEIGHT", "1080"))
+SCREENSHOT_QUALITY = int(os.getenv("SCREENSHOT_QUALITY", "85"))
 COLUMNS = int(os.getenv("COLLAGE_COLUMNS", "3"))
+COLLAGE_QUALITY = int(os.getenv("COLLAGE_QUALITY", "85"))
+BROWSER_WORKERS = int(os.getenv("BROWSER_WORKERS", "2"))
+# Persisted Chrome profiles (one per worker) keep the login between runs; empty disables
+CHROME_PROFILE = os.getenv("CHROME_PROFILE", "/output/chrome-profile")
 
-def setup_driver():
-    """Setup headless Chrome driver"""
+def setup_driver(profile_dir=None):
+    """Setup headless Chrome driver, optionally on a persistent profile"""
     chrome_options = Options()
     chrome_options.add_argument("--headless")
     chrome_options.add_argument("--no-sandbox")
     chrome_options.add_argument("--disable-dev-shm-usage")
     chrome_options.add_argument("--disable-gpu")
     chrome_options.add_argument(f"--window-size={SCREENSHOT_WIDTH},{SCREENSHOT_HEIGHT}")
+    if profile_dir:
+        chrome_options.add_argument(f"--user-data-dir={profile_dir}")
     
     driver = webdriver.Chrome(options=chrome_options)
+    
+    # Pin the viewport so every capture is exactly the configured size,
+    # whatever the DPR or scrollbars; the collage relies on this
+    driver.execute_cdp_cmd("Emulation.setDeviceMetricsOverride", {
+        "width": SCREENSHOT_WIDTH,
+        "height": SCREENSHOT_HEIGHT,
+        "deviceScaleFactor": 1,
+        "mobile": False,
+    })
     return driver
 
 def login_to_reitti(driver):
-    """Log in to Reitti"""
-    if not REITTI_USERNAME or not REITTI_PASSWORD:
-        print("ERROR: REITTI_USERNAME and REITTI_PASSWORD environment variables must be set!")
-        sys.exit(1)
-    
-    print(f"Logging in to Reitti as {REITTI_USERNAME}...")
-    
+    """Log in to Reitti, unless the profile already holds a session"""
     try:
-        # Go to base URL (should show login form)
+        # Go to base URL (shows the login form unless already logged in)
         driver.get(REITTI_BASE_URL)
-        time.sleep(LOGIN_WAIT_TIME)
         
-        # Find and fill username field by ID
-        username_field = driver.find_element("id", "username")
+        # Find the username field by ID; no field means the saved session is still valid
+        username_fields = driver.find_elements("id", "username")
+        if not username_fields and "/login" not in driver.current_url:
+            print("  ✓ Already logged in (saved session)")
+            return True
+        
+        print(f"Logging in to Reitti as {REITTI_USERNAME}...")
+        
+        # Fill username field
+        username_field = WebDriverWait(driver, LOGIN_WAIT_TIME).until(
+            EC.presence_of_element_located((By.ID, "username"))
+        )
         username_field.clear()
         username_field.send_keys(REITTI_USERNAME)
         
@@ -66,8 +96,11 @@ def login_to_reitti(driver):
         login_button = driver.find_element("css selector", "button[type='submit']")
         login_button.click()
         
-        # Wait for redirect after login
-        time.sleep(LOGIN_WAIT_TIME)
+        # Wait for redirect after login (the old form goes stale)
+        try:
+            WebDriverWait(driver, LOGIN_WAIT_TIME).until(EC.staleness_of(login_button))
+        except TimeoutException:
+            pass
         
         # Check if we're still on the login page (login failed)
         if "/login" in driver.current_url or "login-container" in driver.page_source:
@@ -86,6 +119,68 @@ def login_to_reitti(driver):
         print("  3. Increase LOGIN_WAIT_TIME if page loads slowly")
         return False
 
+def make_worker(worker_id):
+    """Start a headless Chrome driver logged in to Reitti, or None if login fails"""
+    # Chrome locks its profile, so every concurrent worker needs its own
+    profile_dir = os.path.join(CHROME_PROFILE, f"worker-{worker_id}") if CHROME_PROFILE else None
+    driver = setup_driver(profile_dir)
+    
+    # Instances without authentication need no login
+    if not REITTI_USERNAME or not REITTI_PASSWORD:
+        print("No REITTI_USERNAME/REITTI_PASSWORD set, skipping login")
+        return driver
+    
+    if not login_to_reitti(driver):
+        driver.quit()
+        return None
+    return driver
+
+def capture_chunk(worker_id, years, month, day):
+    """Capture a subset of years in its own browser, returns {year: path} or None if login failed"""
+    driver = make_worker(worker_id)
+    if driver is None:
+        return None
+    
+    captured = {}
+    try:
+        for year in years:
+            date_str = f"{year}-{month:02d}-{day:02d}"
+            screenshot_path = os.path.join(
+                SCREENSHOT_DIR, 
+                f"reitti_{date_str}.jpg"
+            )
+            
+            if take_screenshot(driver, date_str, screenshot_path):
+                captured[year] = screenshot_path
+    finally:
+        driver.quit()
+    
+    return captured
+
+def tiles_loaded(driver):
+    """True once the map has tiles and none of them is still loading"""
+    return driver.execute_script(
+        "return document.querySelector('.leaflet-tile') !== null"
+        " && document.querySelector('.leaflet-tile:not(.leaflet-tile-loaded)') === null"
+    )
+
+def wait_for_page(driver):
+    """Wait until all map tiles (and the track, if the day has one) have rendered"""
+    try:
+        WebDriverWait(driver, WAIT_TIME).until(tiles_loaded)
+    except TimeoutException:
+        print(f"  ! Page not ready after {WAIT_TIME}s, capturing anyway")
+        return
+    
+    # A day with no recorded track never draws one, so a missing track is not an error
+    try:
+        WebDriverWait(driver, TRACK_WAIT_TIME).until(
+            lambda d: d.find_elements(By.CSS_SELECTOR, READY_SELECTOR)
+        )
+    except TimeoutException:
+        pass
+    time.sleep(SETTLE_TIME)
+
 def take_screenshot(driver, date_str, output_path):
     """Take screenshot of Reitti for a specific date"""
     url = f"{REITTI_BASE_URL}?date={date_str}"
@@ -93,8 +188,15 @@ def take_screenshot(driver, date_str, output_path):
     
     try:
         driver.get(url)
-        time.sleep(WAIT_TIME)  # Wait for page to fully load
-        driver.save_screenshot(output_path)
+        wait_for_page(driver)
+        # Capture straight through CDP as JPEG instead of a WebDriver PNG round trip
+        data = driver.execute_cdp_cmd("Page.captureScreenshot", {
+            "format": "jpeg",
+            "quality": SCREENSHOT_QUALITY,
+            "captureBeyondViewport": False,
+        })
+        with open(output_path, "wb") as f:
+            f.write(base64.b64decode(data["data"]))
         print(f"  ✓ Saved to {output_path}")
         return True
     except Exception as e:
@@ -103,47 +205,60 @@ def take_screenshot(driver, date_str, output_path):
 
 def create_collage(image_paths, output_path, columns=3):
     """Create a collage from multiple screenshots"""
-    images = []
-    valid_paths = []
-    
-    # Load all valid images
-    for path in image_paths:
-        if os.path.exists(path):
-            try:
-                img = Image.open(path)
-                images.append(img)
-                valid_paths.append(path)
-            except Exception as e:
-                print(f"Error loading {path}: {e}")
-    
-    if not images:
+    valid_paths = [path for path in image_paths if os.path.exists(path)]
+    
+    # Calculate dimensions from the first image that loads (all captures share it),
+    # dropping any unreadable ones in front of it
+    size = None
+    while valid_paths and size is None:
+        try:
+            with Image.open(valid_paths[0]) as img:
+                size = img.size
+        except Exception as e:
+            print(f"Error loading {valid_paths.pop(0)}: {e}")
+    
+    if size is None:
         print("No valid images to create collage")
         return False
     
-    # Calculate dimensions
-    img_width, img_height = images[0].size
-    rows = (len(images) + columns - 1) // columns
+    img_width, img_height = size
+    rows = (len(valid_paths) + columns - 1) // columns
     
     # Create blank canvas
     collage_width = columns * img_width
     collage_height = rows * img_height
     collage = Image.new('RGB', (collage_width, collage_height), 'white')
     
-    # Paste images
-    for idx, img in enumerate(images):
+    # Paste images in a single pass, decoding and closing one at a time
+    idx = 0
+    for path in valid_paths:
         row = idx // columns
         col = idx % columns
         x = col * img_width
         y = row * img_height
         
-        # Resize image to fit if needed
-        if img.size != (img_width, img_height):
-            img = img.resize((img_width, img_height), Image.Resampling.LANCZOS)
-        
-        collage.paste(img, (x, y))
+        try:
+            with Image.open(path) as img:
+                # Lets JPEG sources scale down while decoding (no-op otherwise)
+                img.draft('RGB', (img_width, img_height))
+                # setup_driver pins every capture to the same size, so no resize
+                collage.paste(img, (x, y))
+            idx += 1
+        except Exception as e:
+            print(f"Error loading {path}: {e}")
+    
+    if not idx:
+        print("No valid images to create collage")
+        return False
+    
+    # Drop rows left empty by images that failed to load
+    used_rows = (idx + columns - 1) // columns
+    if used_rows < rows:
+        collage = collage.crop((0, 0, collage_width, used_rows * img_height))
     
     # Save collage
-    collage.save(output_path, quality=95)
+    collage.save(output_path, 'JPEG', quality=COLLAGE_QUALITY, progressive=True,
+                 optimize=False, subsampling=2)
     print(f"\n✓ Collage saved to: {output_path}")
     return True
 
@@ -163,42 +278,35 @@ def main():
     print(f"Years: {START_YEAR} to {current_year}")
     print(f"Base URL: {REITTI_BASE_URL}\n")
     
-    # Setup browser
-    print("Initializing headless browser...")
-    driver = setup_driver()
+    # Shard the years across browsers; each one logs in once
+    years = list(range(START_YEAR, current_year + 1))
+    workers = max(1, min(BROWSER_WORKERS, len(years)))
+    chunks = [years[i::workers] for i in range(workers)]
     
-    # Login to Reitti
-    if not login_to_reitti(driver):
-        driver.quit()
+    print(f"Initializing {workers} headless browser(s)...")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda item: capture_chunk(*item, month, day), enumerate(chunks)))
+    
+    if any(result is None for result in results):
         sys.exit(1)
     
-    screenshot_paths = []
+    captured = {}
+    for result in results:
+        captured.update(result)
+    screenshot_paths = [captured[year] for year in years if year in captured]
     
-    try:
-        # Take screenshots for each year
-        for year in range(START_YEAR, current_year + 1):
-            date_str = f"{year}-{month:02d}-{day:02d}"
-            screenshot_path = os.path.join(
-                SCREENSHOT_DIR, 
-                f"reitti_{date_str}.png"
-            )
-            
-            if take_screenshot(driver, date_str, screenshot_path):
-                screenshot_paths.append(screenshot_path)
-        
-        print(f"\n✓ Captured {len(screenshot_paths)} screenshots")
-        
-        # Create collage
-        if screenshot_paths:
-            collage_filename = f"reitti_collage_{month:02d}-{day:02d}_{START_YEAR}-{current_year}.png"
-            collage_path = os.path.join(OUTPUT_DIR, collage_filename)
-            
-            print(f"\nCreating collage...")
-            create_collage(screenshot_paths, collage_path, columns=COLUMNS)
+    print(f"\n✓ Captured {len(screenshot_paths)} screenshots")
+    
+    # Create collage
+    if screenshot_paths:
+        collage_filename = f"reitti_collage_{month:02d}-{day:02d}_{START_YEAR}-{current_year}.jpg"
+        collage_path = os.path.join(OUTPUT_DIR, collage_filename)
         
-    finally:
-        driver.quit()
-        print("\n✓ Done!")
+        print(f"\nCreating collage...")
+        create_collage(screenshot_paths, collage_path, columns=COLUMNS)
+    
+    print("\n✓ Done!")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file